@@ -1,28 +1,219 @@
+"""Проверка шаблонов .docx перед запуском бота.
+
+Проверяет все шаблоны из CATEGORIES параллельно и для каждого показывает:
+поля, поля без подписи в FIELD_DISPLAY_NAMES, поля разбитые на несколько run,
+время разбора и рендера, размер до и после оптимизации. Если найдены ошибки - выходит с кодом 1.
+
+Запуск:
+    python check_templates.py            # обычная проверка
+    python check_templates.py --jobs 4   # число параллельных процессов
+    python check_templates.py --strict   # предупреждения тоже считаются ошибками
+"""
 import os
+import io
+import re
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from docx import Document
+
+from full_bot import (
+    CATEGORIES, FIELD_DISPLAY_NAMES, IGNORED_FIELDS, AUTO_FILLED_FIELDS,
+    LIST_FIELDS, fill_document, split_placeholder, optimize_docx_package
+)
+
+PLACEHOLDER_RE = re.compile(r'\{(.*?)\}')
+VALID_FIELD_RE = re.compile(r'^\w+$')
+
+def iter_body_paragraphs(doc):
+    """Параграфы, которые заполняет бот: основной текст и таблицы"""
+    yield from doc.paragraphs
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                yield from cell.paragraphs
+
+def iter_header_footer_paragraphs(doc):
+    """Параграфы колонтитулов - бот их НЕ заполняет"""
+    for section in doc.sections:
+        for part in (section.header, section.footer):
+            yield from part.paragraphs
+            for table in part.tables:
+                for row in table.rows:
+                    for cell in row.cells:
+                        yield from cell.paragraphs
+
+def setup_worker_logging():
+    """Обычный вывод логов в рабочих процессах - ошибки рендера не должны теряться"""
+    logging.basicConfig(level=logging.WARNING, format='   %(levelname)s %(message)s')
+
+def check_template(category, template_name, template_file):
+    """Проверяет один шаблон и возвращает словарь с результатами"""
+    template_path = f"templates/{template_file}"
+    result = {
+        'category': category,
+        'template_name': template_name,
+        'template_path': template_path,
+        'fields': [],
+        'errors': [],
+        'warnings': [],
+        'parse_ms': None,
+        'render_ms': None,
+        'size': None,
+    }
+
+    if not os.path.exists(template_path):
+        result['errors'].append("файл не найден")
+        return result
+
+    try:
+        started = time.perf_counter()
+        doc = Document(template_path)
+        result['parse_ms'] = (time.perf_counter() - started) * 1000
+    except Exception as e:
+        result['errors'].append(f"не удалось открыть: {e}")
+        return result
+
+    try:
+        with open(template_path, 'rb') as f:
+            data = f.read()
+        result['size'] = (len(data), len(optimize_docx_package(data)))
+    except Exception as e:
+        result['errors'].append(f"ошибка оптимизации: {e}")
+
+    fields = []
+    placeholders = []
+    split_fields = []
+    for paragraph in iter_body_paragraphs(doc):
+        for field in PLACEHOLDER_RE.findall(paragraph.text):
+            if field not in placeholders:
+                placeholders.append(field)
+            # Поле целиком не лежит ни в одном run - при замене форматирование абзаца сведется к первому run
+            placeholder = f"{{{field}}}"
+            if not any(placeholder in run.text for run in paragraph.runs) and field not in split_fields:
+                split_fields.append(field)
+        # Незакрытые скобки - поле не будет найдено вовсе
+        if paragraph.text.count('{') != paragraph.text.count('}'):
+            result['errors'].append(f"непарные фигурные скобки: {paragraph.text.strip()[:60]!r}")
+    result['fields'] = placeholders
+
+    for placeholder in placeholders:
+        field, column = split_placeholder(placeholder)
+        if field not in fields:
+            fields.append(field)
+
+        if not VALID_FIELD_RE.match(field) or (column is not None and not VALID_FIELD_RE.match(column)):
+            result['errors'].append(f"недопустимое имя поля {{{placeholder}}} (только буквы, цифры и _)")
+        elif (column is not None or placeholder[0] in '#/') and field not in LIST_FIELDS:
+            result['errors'].append(f"{{{placeholder}}}: {field} нет в LIST_FIELDS")
+        elif column is not None and column != 'n' and column not in LIST_FIELDS[field]:
+            result['errors'].append(f"{{{placeholder}}}: у списка {field} нет колонки {column}")
+        elif field not in FIELD_DISPLAY_NAMES and field not in AUTO_FILLED_FIELDS and field not in IGNORED_FIELDS:
+            result['errors'].append(f"поле {{{field}}} без подписи в FIELD_DISPLAY_NAMES")
+
+    # Блоки {#список}...{/список} должны быть парными
+    for field in fields:
+        if (f"#{field}" in placeholders) != (f"/{field}" in placeholders):
+            result['errors'].append(f"непарные маркеры блока {{#{field}}} / {{/{field}}}")
+
+    if split_fields:
+        result['warnings'].append(f"поля разбиты на несколько run: {', '.join(split_fields)}")
+
+    for paragraph in iter_header_footer_paragraphs(doc):
+        for field in PLACEHOLDER_RE.findall(paragraph.text):
+            result['errors'].append(f"поле {{{field}}} в колонтитуле - бот его не заполнит")
+
+    # Пробный рендер: все поля должны замениться, списки - размножиться
+    data = {}
+    for field in fields:
+        if field in IGNORED_FIELDS:
+            continue
+        if field in LIST_FIELDS:
+            data[field] = [{column: f"<{column}>" for column in LIST_FIELDS[field]} for _ in range(2)]
+        else:
+            data[field] = f"<{field}>"
+    try:
+        started = time.perf_counter()
+        fill_document(doc, data)
+        doc.save(io.BytesIO())
+        result['render_ms'] = (time.perf_counter() - started) * 1000
+    except Exception as e:
+        result['errors'].append(f"ошибка рендера: {e}")
+        return result
+
+    for paragraph in iter_body_paragraphs(doc):
+        for placeholder in PLACEHOLDER_RE.findall(paragraph.text):
+            if split_placeholder(placeholder)[0] in data:
+                result['errors'].append(f"поле {{{placeholder}}} осталось после рендера")
+
+    return result
+
+def print_result(result, strict):
+    """Печатает результат проверки одного шаблона"""
+    ok = not result['errors'] and not (strict and result['warnings'])
+    timings = ""
+    if result['parse_ms'] is not None:
+        timings = f" (разбор {result['parse_ms']:.0f} мс"
+        if result['render_ms'] is not None:
+            timings += f", рендер {result['render_ms']:.0f} мс"
+        timings += ")"
+
+    print(f"{'✅' if ok else '❌'} {result['template_name']}: {result['template_path']}{timings}")
+    if result['fields']:
+        print(f"   📋 Поля ({len(result['fields'])}): {', '.join(result['fields'])}")
+    if result['size']:
+        original, optimized = result['size']
+        print(f"   📦 Размер: {original} → {optimized} Б (−{(original - optimized) * 100 // max(1, original)}%)")
+    for error in result['errors']:
+        print(f"   ❌ {error}")
+    for warning in result['warnings']:
+        print(f"   ⚠️ {warning}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка шаблонов .docx для бота")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="число параллельных процессов")
+    parser.add_argument('--strict', action='store_true',
+                        help="считать предупреждения ошибками")
+    args = parser.parse_args()
+
+    # Пути к шаблонам относительные - работаем из папки проекта
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    print("🔍 Проверяем шаблоны...")
+
+    jobs = [
+        (category, template_name, template_file)
+        for category, templates in CATEGORIES.items()
+        for template_name, template_file in templates.items()
+    ]
+
+    started = time.perf_counter()
+    setup_worker_logging()
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs), initializer=setup_worker_logging) as executor:
+        results = list(executor.map(check_template, *zip(*jobs)))
+    elapsed = time.perf_counter() - started
+
+    failed = 0
+    current_category = None
+    for result in results:
+        if result['category'] != current_category:
+            current_category = result['category']
+            print(f"\n📁 Категория: {current_category}")
+        if not print_result(result, args.strict):
+            failed += 1
+
+    print(f"\n⏱ Проверено шаблонов: {len(results)} за {elapsed:.2f} с")
+    if failed:
+        print(f"❌ Шаблонов с ошибками: {failed}")
+        return 1
+
+    print("✅ Все шаблоны в порядке")
+    return 0
 
-print("🔍 Проверяем шаблоны...")
-print(f"📁 Текущая папка: {os.getcwd()}")
-
-# Проверяем папку templates
-if not os.path.exists("templates"):
-    print("❌ Папка 'templates' не существует!")
-    print("Создаю папку...")
-    os.makedirs("templates")
-else:
-    print("✅ Папка 'templates' существует")
-
-# Проверяем файлы шаблонов
-templates = {
-    "history.docx": "📋 История болезни",
-    "extract.docx": "📄 Выписка", 
-    "prescription.docx": "💊 Назначения"
-}
-
-for filename, description in templates.items():
-    path = f"templates/{filename}"
-    if os.path.exists(path):
-        print(f"✅ {description}: {filename} - найден")
-    else:
-        print(f"❌ {description}: {filename} - НЕ НАЙДЕН!")
-
-print("\n📝 Если файлы не найдены, создай их в папке templates/")
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
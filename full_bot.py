@@ -1,31 +1,134 @@
 import os
+import io
+import sys
+import asyncio
 import logging
+import logging.handlers
+from queue import SimpleQueue
+import atexit
 import re
-from datetime import datetime
+import copy
+import json
+import time
+import random
+import zipfile
+import posixpath
+from datetime import timedelta
+from array import array
+from functools import lru_cache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError, NetworkError, BadRequest, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, CallbackContext, 
     CallbackQueryHandler, MessageHandler, filters,
-    ConversationHandler
+    ConversationHandler, BaseUpdateProcessor
 )
 from docx import Document
-import tempfile
-import shutil
+from docx.oxml.ns import qn
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from lxml import etree
+from docx.text.paragraph import Paragraph
 from dotenv import load_dotenv
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования.
+# Обработчики только кладут запись в очередь, а в stdout ее пишет отдельный поток
+# (QueueListener) - print() и синхронный вывод больше не блокируют event loop.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text или json
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))  # Какую долю частых сообщений писать
+LOG_REDACT = os.getenv('LOG_REDACT', '1') == '1'  # Скрывать введенные данные пациентов
+
+# Структурированные поля, значения которых в логи не попадают
+REDACTED_LOG_FIELDS = {'value', 'values'}
+
+class StructuredFormatter(logging.Formatter):
+    """Добавляет к сообщению структурированные поля (extra={'fields': {...}})"""
+    
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if LOG_FORMAT == 'json':
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+            }
+            entry.update(fields)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        
+        message = super().format(record)
+        if fields:
+            message += ' | ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+class RedactingFilter(logging.Filter):
+    """Заменяет значения полей с данными пациентов на '***' (оставляя длину)"""
+    
+    def filter(self, record):
+        fields = getattr(record, 'fields', None)
+        if LOG_REDACT and fields and REDACTED_LOG_FIELDS.intersection(fields):
+            record.fields = {
+                key: f"***({len(str(value))})" if key in REDACTED_LOG_FIELDS else value
+                for key, value in fields.items()
+            }
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только LOG_SAMPLE_RATE сообщений с горячих путей (extra={'sampled': True})"""
+    
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and record.levelno < logging.WARNING:
+            return random.random() < LOG_SAMPLE_RATE
+        return True
+
+def log_extra(sampled=False, **fields):
+    """extra для logger: структурированные поля и признак выборочной записи"""
+    return {'fields': fields, 'sampled': sampled}
+
+def setup_logging():
+    """Root logger -> очередь -> поток записи в stdout"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RedactingFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет каждый запрос к Bot API вместе с токеном в URL
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 logger = logging.getLogger(__name__)
 
 # ==== ПОЛУЧАЕМ ПЕРЕМЕННЫЕ ИЗ .env ====
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMINS_STRING = os.getenv('ADMINS', '')  # Получаем строку с ID админов
+PROFILES_FILE = os.getenv('PROFILES_FILE', 'user_profiles.json')  # Профили врачей
+RENDER_AHEAD = int(os.getenv('RENDER_AHEAD', '2'))  # Сколько документов готовим заранее, пока идет отправка
+MAX_CONCURRENT_UPLOADS = int(os.getenv('MAX_CONCURRENT_UPLOADS', '4'))  # Одновременных отправок на весь бот
+SESSION_TTL = int(os.getenv('SESSION_TTL', '1800'))  # Через сколько секунд бездействия удалять сессию (0 - никогда)
+SESSION_SWEEP_INTERVAL = 60  # Как часто проверять сессии на истечение, секунд
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))  # Сколько обновлений обрабатывать одновременно
+UNLIMITED_UPDATES = 2 ** 20  # Лимит семафора PTB - реальный лимит держит PerChatUpdateProcessor
+CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', '64'))  # Размер пула HTTP соединений к Bot API
+POOL_TIMEOUT = float(os.getenv('POOL_TIMEOUT', '10'))  # Сколько ждать свободное соединение из пула, секунд
+DELIVERY_RETRIES = int(os.getenv('DELIVERY_RETRIES', '5'))  # Повторов при сетевых ошибках и flood control
+DELIVERY_BACKOFF = float(os.getenv('DELIVERY_BACKOFF', '1'))  # Начальная задержка между повторами, секунд
+DELIVERY_BACKOFF_MAX = 30  # Максимальная задержка между повторами, секунд
+OPTIMIZE_DOCX = os.getenv('OPTIMIZE_DOCX', '1') == '1'  # Уменьшать размер готовых .docx
+DOCX_ZIP_LEVEL = int(os.getenv('DOCX_ZIP_LEVEL', '9'))  # Уровень сжатия zip (0-9)
+REPACK_OUTPUT = os.getenv('REPACK_OUTPUT', '0') == '1'  # Пересжимать каждый готовый документ (рендер ~40% медленнее, файлы ~0.6% меньше)
 
 # Преобразуем строку админов в список чисел
 ADMINS = []
@@ -33,23 +136,12 @@ if ADMINS_STRING:
     try:
         ADMINS = [int(admin_id.strip()) for admin_id in ADMINS_STRING.split(',')]
     except ValueError as e:
-        print(f"❌ Ошибка преобразования ADMINS: {e}")
+        logger.error(f"❌ Ошибка преобразования ADMINS: {e}")
         ADMINS = []
 
-# Проверяем что токен и админы загружены
-if not BOT_TOKEN:
-    print("❌ BOT_TOKEN не найден в .env файле!")
-    exit(1)
-
-if not ADMINS:
-    print("❌ ADMINS не найдены в .env файле!")
-    exit(1)
-
-print(f"✅ Токен загружен: {'*' * 10}{BOT_TOKEN[-5:]}")
-print(f"✅ Админы: {ADMINS}")
-
 # Состояния диалога
 SELECTING_CATEGORY, SELECTING_TEMPLATES, FILLING_DATA = range(3)
+PROFILE_MENU, PROFILE_INPUT = range(3, 5)
 
 # СТРУКТУРА КАТЕГОРИЙ И ШАБЛОНОВ
 CATEGORIES = {
@@ -68,22 +160,390 @@ CATEGORIES = {
     }
 }
 
+# Названия полей как в документах
+FIELD_DISPLAY_NAMES = {
+    # Основные данные
+    "name": "👤 ФИО пациента",
+    "birth_date": "📅 Дата рождения (ДД.ММ.ГГГГ)",
+    "address": "📍 Адрес регистрации по месту жительства",
+    "address_fact": "🏠 Адрес фактического проживания",
+    
+    # Документы
+    "oms": "📋 Номер полиса ОМС",
+    "snils": "📘 СНИЛС",
+    
+    # Диагнозы
+    "diagnosis": "🏥 Установлен клинический диагноз",
+    "diagnosis_code": "🔢 Код по МКБ-10",
+    
+    # Медицинская информация
+    "medical_history": "📋 Anamnesis morbi",
+    "status_localis": "📊 Status localis",
+    
+    # ВМП данные
+    "wmp": "🔬 Наименование вида ВМП",
+    "wmp_oms": "💊 Наименование вида ВМП в ОМС",
+    "wmp_group": "📁 № группы ВМП",
+    "wmp_code": "🔢 Код вида ВМП",
+    "wmp_oms_group": "📂 № группы ВМП в ОМС", 
+    "wmp_oms_code": "🔣 Код вида ВМП в ОМС",
+    "patient_model": "👥 Модель пациента",
+    "treatment_method": "💉 Метод лечения ВМП",
+    
+    # ОМС данные
+    "ksg_group": "📊 Группа КСГ",
+    "operation_code": "🔪 Код операции",
+    
+    # Заключения
+    "recommendations": "📝 Рекомендации / Решение комиссии",
+    
+    # Врачи
+    "doctor": "👨‍⚕️ ФИО врача",
+    "fio_lech": "👩‍⚕️ ФИО лечащего врача (для подписи)",
+    "department": "🏢 Отделение",
+    
+    # Списки (повторяющиеся строки таблиц)
+    "lab_results": "🧪 Результаты анализов",
+    "medications": "💊 Лекарственные назначения",
+    "operations": "🔪 Операции"
+}
+
+# СПИСОЧНЫЕ ПОЛЯ: колонки каждой записи в порядке ввода.
+# В шаблоне строка таблицы с {lab_results.name}, {lab_results.value}...
+# повторяется для каждой записи; {lab_results.n} - номер записи.
+# Блок абзацев между {#medications} и {/medications} тоже повторяется.
+LIST_FIELDS = {
+    "lab_results": {
+        "name": "показатель",
+        "value": "результат",
+        "unit": "ед. изм."
+    },
+    "medications": {
+        "name": "препарат",
+        "dose": "доза",
+        "schedule": "схема приема"
+    },
+    "operations": {
+        "operation_code": "код операции",
+        "name": "название",
+        "date": "дата"
+    }
+}
+
+# Разделитель колонок при вводе списка
+LIST_COLUMN_SEPARATOR = ";"
+
+# Служебные поля, которые не спрашиваются у пользователя
+IGNORED_FIELDS = ['hist_number', 'current_date']
+
+# Поля, которые заполняются автоматически (все диагнозы = клинический диагноз)
+AUTO_FILLED_FIELDS = ["sop_diagnosis", "main_diagnosis"]
+
+# Поля, которые почти не меняются у одного врача - запоминаем их в профиле
+PROFILE_FIELDS = ["doctor", "fio_lech", "department"]
+
+# ==== ПРОФИЛИ ВРАЧЕЙ ====
+# Кэш профилей в памяти: {user_id (str): {field: value}}
+_user_profiles = None
+
+def load_user_profiles():
+    """Загружает профили врачей из файла (один раз, дальше - из кэша)"""
+    global _user_profiles
+    if _user_profiles is None:
+        try:
+            with open(PROFILES_FILE, 'r', encoding='utf-8') as f:
+                _user_profiles = json.load(f)
+        except FileNotFoundError:
+            _user_profiles = {}
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Ошибка чтения профилей {PROFILES_FILE}: {e}")
+            _user_profiles = {}
+    return _user_profiles
+
+def save_user_profiles():
+    """Сохраняет профили врачей в файл атомарно (через временный файл)"""
+    profiles = load_user_profiles()
+    tmp_path = f"{PROFILES_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(profiles, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, PROFILES_FILE)
+    except OSError as e:
+        logger.error(f"❌ Ошибка сохранения профилей {PROFILES_FILE}: {e}")
+
+def get_user_profile(user_id):
+    """Возвращает сохраненные значения полей профиля для пользователя"""
+    return load_user_profiles().get(str(user_id), {})
+
+def set_profile_value(user_id, field_name, value):
+    """Запоминает значение поля профиля (пишет на диск только при изменении)"""
+    profiles = load_user_profiles()
+    profile = profiles.setdefault(str(user_id), {})
+    if profile.get(field_name) != value:
+        profile[field_name] = value
+        save_user_profiles()
+
+def clear_user_profile(user_id):
+    """Удаляет профиль пользователя - поля снова будут спрашиваться"""
+    profiles = load_user_profiles()
+    if profiles.pop(str(user_id), None) is not None:
+        save_user_profiles()
+
+# ==== ОПТИМИЗАЦИЯ РАЗМЕРА .docx ====
+# Связи на части, которые не нужны в готовом документе: миниатюра, свойства
+# редактора (docProps/custom.xml), встроенные шрифты и customXml
+REMOVABLE_RELATIONSHIP_TYPES = {
+    RT.THUMBNAIL,
+    RT.CUSTOM_PROPERTIES,
+    RT.FONT,
+    RT.CUSTOM_XML,
+}
+
+# Элементы, которые ссылаются на стили по w:val
+STYLE_REFERENCE_TAGS = {
+    'pStyle', 'rStyle', 'tblStyle', 'numStyleLink', 'styleLink',
+    'clickAndTypeStyle', 'defaultTableStyle'
+}
+
+# Размер, сэкономленный на шаблоне при оптимизации: {template_path: байт}
+_template_savings = {}
+# Кэш оптимизированных шаблонов: {template_path: (mtime, bytes)}
+_template_cache = {}
+# Примерная память одного загруженного документа: {template_path: байт}
+_template_memory = {}
+# Во сколько раз дерево lxml в памяти больше исходного XML (замерено по RSS на шаблонах ВМП)
+LXML_MEMORY_FACTOR = 8
+
+def get_rels_name(part_name):
+    """Имя .rels файла для части пакета ('' - сам пакет)"""
+    if not part_name:
+        return '_rels/.rels'
+    directory, name = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', f"{name}.rels")
+
+def resolve_target(part_name, target):
+    """Путь части, на которую указывает связь, относительно корня пакета"""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(part_name), target))
+
+def prune_styles(entries):
+    """Удаляет неиспользуемые стили и latentStyles из word/styles.xml"""
+    styles_blob = entries.get('word/styles.xml')
+    if styles_blob is None:
+        return
+    
+    used = set()
+    for name, blob in entries.items():
+        if name.startswith('word/') and name.endswith('.xml') and name != 'word/styles.xml':
+            for element in etree.fromstring(blob).iter('{*}*'):
+                if etree.QName(element).localname in STYLE_REFERENCE_TAGS and element.get(qn('w:val')):
+                    used.add(element.get(qn('w:val')))
+    
+    root = etree.fromstring(styles_blob)
+    styles = {style.get(qn('w:styleId')): style for style in root.findall(qn('w:style'))}
+    
+    # Оставляем стили по умолчанию, используемые и все, от которых они зависят
+    keep = {style_id for style_id, style in styles.items() if style.get(qn('w:default')) == '1'}
+    keep.update(used)
+    pending = list(keep)
+    while pending:
+        style = styles.get(pending.pop())
+        if style is None:
+            continue
+        for tag in ('w:basedOn', 'w:link', 'w:next'):
+            reference = style.find(qn(tag))
+            if reference is not None and reference.get(qn('w:val')) not in keep:
+                keep.add(reference.get(qn('w:val')))
+                pending.append(reference.get(qn('w:val')))
+    
+    for style_id, style in styles.items():
+        if style_id not in keep:
+            root.remove(style)
+    for latent_styles in root.findall(qn('w:latentStyles')):
+        root.remove(latent_styles)
+    
+    entries['word/styles.xml'] = etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+def repack_docx(entries, level=None):
+    """Собирает zip-пакет .docx с нужным уровнем сжатия"""
+    if isinstance(entries, bytes):
+        with zipfile.ZipFile(io.BytesIO(entries)) as source:
+            entries = {name: source.read(name) for name in source.namelist()}
+    level = DOCX_ZIP_LEVEL if level is None else level
+    
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as target:
+        # [Content_Types].xml по соглашению идет первым
+        names = sorted(entries, key=lambda name: name != '[Content_Types].xml')
+        for name in names:
+            target.writestr(name, entries[name], compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+    return buffer.getvalue()
+
+def optimize_docx_package(data):
+    """Удаляет из пакета .docx ненужные части и неиспользуемые стили, пересжимает zip"""
+    with zipfile.ZipFile(io.BytesIO(data)) as source:
+        entries = {name: source.read(name) for name in source.namelist()}
+    
+    # Обходим связи от корня пакета: что недостижимо - в итоговый файл не попадет
+    reachable = set()
+    removed_ids = {}  # {part_name: {rId удаленных связей}}
+    pending = ['']
+    while pending:
+        part_name = pending.pop()
+        rels_name = get_rels_name(part_name)
+        if rels_name not in entries:
+            continue
+        
+        root = etree.fromstring(entries[rels_name])
+        changed = False
+        for rel in list(root):
+            if rel.get('TargetMode') == 'External':
+                continue
+            if rel.get('Type') in REMOVABLE_RELATIONSHIP_TYPES:
+                root.remove(rel)
+                removed_ids.setdefault(part_name, set()).add(rel.get('Id'))
+                changed = True
+                continue
+            target = resolve_target(part_name, rel.get('Target'))
+            if target not in reachable:
+                reachable.add(target)
+                pending.append(target)
+        if changed:
+            entries[rels_name] = etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+    
+    keep = {'[Content_Types].xml', get_rels_name('')}
+    for part_name in reachable:
+        keep.add(part_name)
+        keep.add(get_rels_name(part_name))
+    entries = {name: blob for name, blob in entries.items() if name in keep}
+    
+    # Убираем из [Content_Types].xml удаленные части
+    content_types = etree.fromstring(entries['[Content_Types].xml'])
+    for override in list(content_types):
+        part_name = override.get('PartName')
+        if part_name and part_name.lstrip('/') not in entries:
+            content_types.remove(override)
+    entries['[Content_Types].xml'] = etree.tostring(content_types, xml_declaration=True, encoding='UTF-8', standalone=True)
+    
+    # Ссылки на удаленные встроенные шрифты
+    font_table_ids = removed_ids.get('word/fontTable.xml')
+    if font_table_ids and 'word/fontTable.xml' in entries:
+        root = etree.fromstring(entries['word/fontTable.xml'])
+        for element in list(root.iter('{*}*')):
+            if etree.QName(element).localname.startswith('embed') and element.get(qn('r:id')) in font_table_ids:
+                element.getparent().remove(element)
+        entries['word/fontTable.xml'] = etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)
+    
+    prune_styles(entries)
+    return repack_docx(entries)
+
+def get_template_bytes(template_path):
+    """Оптимизированный шаблон в байтах - оптимизация выполняется один раз на файл"""
+    mtime = os.path.getmtime(template_path)
+    cached = _template_cache.get(template_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    
+    with open(template_path, 'rb') as f:
+        data = f.read()
+    
+    if OPTIMIZE_DOCX:
+        try:
+            optimized = optimize_docx_package(data)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось оптимизировать {template_path}: {e}")
+            optimized = data
+        if len(optimized) < len(data):
+            _template_savings[template_path] = len(data) - len(optimized)
+            logger.info("📦 Шаблон оптимизирован", extra=log_extra(
+                template=template_path, size_before=len(data), size_after=len(optimized)
+            ))
+            data = optimized
+    
+    _template_cache[template_path] = (mtime, data)
+    _template_memory[template_path] = estimate_document_memory(data)
+    return data
+
+def estimate_document_memory(data):
+    """Примерный объем памяти документа python-docx, загруженного из data"""
+    size = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith(('.xml', '.rels')):
+                size += info.file_size * LXML_MEMORY_FACTOR
+            else:
+                size += info.file_size
+    return size
+
+def load_template(template_path):
+    """Загружает шаблон (из кэша оптимизированных)"""
+    return Document(io.BytesIO(get_template_bytes(template_path)))
+
+def save_document(doc, template_name, template_path=None):
+    """Сохраняет документ в байты. Возвращает (содержимое, сэкономлено байт).
+
+    Основная экономия - от оптимизации шаблона; пересжатие готового документа
+    с DOCX_ZIP_LEVEL включается через REPACK_OUTPUT.
+    """
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    data = buffer.getvalue()
+    if not OPTIMIZE_DOCX:
+        return data, 0
+    
+    saved = _template_savings.get(template_path, 0)
+    if REPACK_OUTPUT:
+        optimized = repack_docx(data)
+        if len(optimized) < len(data):
+            saved += len(data) - len(optimized)
+            data = optimized
+    
+    logger.debug("📦 Документ сохранен", extra=log_extra(template=template_name, size=len(data), saved=saved))
+    return data, saved
+
+def split_placeholder(placeholder):
+    """Разбирает плейсхолдер на (поле, колонка):
+    'lab_results.name' -> ('lab_results', 'name'),
+    '#medications' и '/medications' -> ('medications', None), 'name' -> ('name', None)"""
+    placeholder = placeholder.lstrip('#/')
+    field, _, column = placeholder.partition('.')
+    return field, column or None
+
+def parse_list_input(field_name, text):
+    """Разбирает ввод списка: одна строка - одна запись, колонки через LIST_COLUMN_SEPARATOR.
+    Возвращает (записи, строки с лишними колонками)"""
+    columns = list(LIST_FIELDS[field_name].keys())
+    items = []
+    bad_lines = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        parts = [part.strip() for part in line.split(LIST_COLUMN_SEPARATOR)]
+        if len(parts) > len(columns):
+            bad_lines.append(line.strip())
+            continue
+        parts += [""] * (len(columns) - len(parts))
+        items.append(dict(zip(columns, parts)))
+    return items, bad_lines
+
 def analyze_docx_template(template_path):
     """Анализирует .docx шаблон и возвращает список полей которые нужно заполнить"""
     try:
         if not os.path.exists(template_path):
-            print(f"❌ Файл {template_path} не найден!")
+            logger.error(f"❌ Файл {template_path} не найден!")
             return []
         
-        doc = Document(template_path)
+        doc = load_template(template_path)
         fields = []
         
         # Ищем поля в формате {field_name} во всех параграфах
         for paragraph in doc.paragraphs:
             found_fields = re.findall(r'\{(.*?)\}', paragraph.text)
-            for field in found_fields:
+            for placeholder in found_fields:
+                field, _ = split_placeholder(placeholder)
                 # ИСКЛЮЧАЕМ поля которые не нужно заполнять
-                if field not in ['hist_number', 'current_date'] and field not in fields:
+                if field not in IGNORED_FIELDS and field not in fields:
                     fields.append(field)
         
         # Ищем поля в таблицах
@@ -91,16 +551,17 @@ def analyze_docx_template(template_path):
             for row in table.rows:
                 for cell in row.cells:
                     found_fields = re.findall(r'\{(.*?)\}', cell.text)
-                    for field in found_fields:
+                    for placeholder in found_fields:
+                        field, _ = split_placeholder(placeholder)
                         # ИСКЛЮЧАЕМ поля которые не нужно заполнять
-                        if field not in ['hist_number', 'current_date'] and field not in fields:
+                        if field not in IGNORED_FIELDS and field not in fields:
                             fields.append(field)
         
-        print(f"✅ В шаблоне {template_path} найдены поля: {fields}")
+        logger.debug("✅ Поля шаблона", extra=log_extra(template=template_path, fields=fields))
         return fields
         
     except Exception as e:
-        print(f"❌ Ошибка анализа шаблона {template_path}: {e}")
+        logger.error(f"❌ Ошибка анализа шаблона {template_path}: {e}")
         return []
 
 def get_required_fields(selected_templates, category):
@@ -142,24 +603,192 @@ def get_required_fields(selected_templates, category):
         # Вставляем сразу после address
         final_fields.insert(address_index + 1, "address_fact")
     
-    print(f"📋 Всего полей для заполнения: {len(final_fields)}")
-    print(f"📋 Порядок полей: {final_fields}")
+    logger.debug("📋 Поля для заполнения", extra=log_extra(count=len(final_fields), fields=final_fields))
     return final_fields
 
-def get_user_input_fields(required_fields):
+def get_user_input_fields(required_fields, profile=None):
     """Возвращает только те поля, которые действительно нужно спрашивать у пользователя"""
-    # Поля, которые заполняются автоматически
-    AUTO_FILLED_FIELDS = ["sop_diagnosis", "main_diagnosis"]
+    profile = profile or {}
     
     user_fields = []
     for field in required_fields:
-        if field not in AUTO_FILLED_FIELDS:
-            user_fields.append(field)
-    
-    print(f"🎯 Поля для ввода пользователем: {len(user_fields)} из {len(required_fields)}")
-    print(f"🎯 Список: {user_fields}")
+        if field in AUTO_FILLED_FIELDS:
+            continue
+        # Поля профиля врача берем из сохраненных значений
+        if field in PROFILE_FIELDS and profile.get(field):
+            continue
+        user_fields.append(field)
+    
+    logger.debug("🎯 Поля для ввода пользователем", extra=log_extra(
+        count=len(user_fields), total=len(required_fields), fields=user_fields
+    ))
     return user_fields
 
+# ==== СЕССИИ ДИАЛОГА ====
+@lru_cache(maxsize=64)
+def get_field_positions(required_fields):
+    """Индексы полей в кортеже required_fields (общие для всех сессий с тем же набором)"""
+    return {field: index for index, field in enumerate(required_fields)}
+
+class FormSession:
+    """Компактное состояние диалога одного пользователя.
+
+    Значения полей хранятся в списке по позиции поля в required_fields,
+    история для отмены - массивом индексов, а не списком словарей.
+    """
+
+    __slots__ = (
+        'chat_id', 'category', 'selected_templates', 'required_fields',
+        'user_input_fields', 'values', 'current_field_index', 'history',
+        'prerender', 'profile_field', 'last_activity'
+    )
+
+    def __init__(self, chat_id=None):
+        self.chat_id = chat_id
+        self.category = None
+        self.selected_templates = []
+        self.required_fields = ()
+        self.user_input_fields = ()
+        self.values = []
+        self.current_field_index = 0
+        self.history = array('H')
+        self.prerender = None
+        self.profile_field = None
+        self.last_activity = time.monotonic()
+
+    def start_filling(self, required_fields, user_input_fields):
+        """Готовит сессию к заполнению полей выбранных шаблонов"""
+        self.required_fields = tuple(required_fields)
+        self.user_input_fields = tuple(user_input_fields)
+        self.values = [None] * len(self.required_fields)
+        self.current_field_index = 0
+        self.history = array('H')
+
+    def set_value(self, field_name, value):
+        """Сохраняет значение поля (поля, которых нет в шаблонах, пропускаются)"""
+        position = get_field_positions(self.required_fields).get(field_name)
+        if position is not None:
+            self.values[position] = value
+
+    def get_value(self, field_name, default=None):
+        position = get_field_positions(self.required_fields).get(field_name)
+        if position is None or self.values[position] is None:
+            return default
+        return self.values[position]
+
+    def push_history(self, field_name):
+        """Запоминает заполненное поле для кнопки "Исправить предыдущее поле" """
+        self.history.append(get_field_positions(self.required_fields)[field_name])
+
+    def pop_history(self):
+        """Возвращает имя последнего заполненного поля и убирает его из истории"""
+        if not self.history:
+            return None
+        return self.required_fields[self.history.pop()]
+
+    def to_data(self, default="Не указано"):
+        """Данные для подстановки в документы"""
+        data = {}
+        for field, value in zip(self.required_fields, self.values):
+            if value is None:
+                value = [] if field in LIST_FIELDS else default
+            data[field] = value
+        return data
+
+    def stop_prerender(self):
+        """Останавливает пред-рендер, если он больше не соответствует выбору шаблонов"""
+        if self.prerender is not None:
+            self.prerender.cancel()
+            self.prerender = None
+
+    def memory_size(self):
+        """Примерный объем памяти данных формы в байтах (пред-рендер считается отдельно)"""
+        size = sys.getsizeof(self)
+        size += sys.getsizeof(self.selected_templates) + sys.getsizeof(self.values)
+        size += sys.getsizeof(self.history)
+        for value in self.values:
+            if value is None:
+                continue
+            size += sys.getsizeof(value)
+            if isinstance(value, list):
+                # Записи списка: словарь строки и ее значения (ключи - общие имена колонок)
+                for row in value:
+                    size += sys.getsizeof(row) + sum(sys.getsizeof(cell) for cell in row.values())
+        return size
+
+def get_session(context: CallbackContext, chat_id=None):
+    """Возвращает сессию пользователя (создает новую при необходимости) и отмечает активность"""
+    session = context.user_data.get('session')
+    if session is None:
+        session = FormSession(chat_id)
+        context.user_data['session'] = session
+    if chat_id is not None:
+        session.chat_id = chat_id
+    session.last_activity = time.monotonic()
+    return session
+
+def drop_session(user_data):
+    """Удаляет сессию формы и останавливает ее пред-рендер"""
+    session = user_data.pop('session', None)
+    if session is not None:
+        session.stop_prerender()
+
+def clear_user_data(user_data):
+    """Удаляет все данные пользователя (сессию, недоставленные документы)"""
+    drop_session(user_data)
+    user_data.clear()
+
+async def expire_idle_sessions(application):
+    """Фоновая задача: удаляет сессии, неактивные дольше SESSION_TTL секунд"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        now = time.monotonic()
+
+        for user_id, user_data in list(application.user_data.items()):
+            # Недоставленные документы тоже держим не дольше SESSION_TTL
+            session = user_data.get('session') or user_data.get('pending_bundle')
+            if session is None or now - session.last_activity < SESSION_TTL:
+                continue
+
+            clear_user_data(user_data)
+            logger.info("⌛ Сессия удалена по таймауту", extra=log_extra(user_id=user_id))
+
+            if getattr(session, 'chat_id', None) is not None:
+                try:
+                    await application.bot.send_message(
+                        session.chat_id,
+                        "⌛ Сессия завершена из-за неактивности.\n"
+                        "Введенные данные удалены.\n\n"
+                        "Для начала используй /start"
+                    )
+                except Exception as e:
+                    logger.warning(f"Не удалось уведомить об истечении сессии: {e}")
+
+async def session_expired(update: Update, context: CallbackContext):
+    """Ответ на сообщение в диалоге, сессия которого уже удалена"""
+    bundle = context.user_data.get('pending_bundle')
+    if bundle is not None and bundle.missing():
+        # Недоставленные документы не трогаем - напоминаем про кнопку досылки
+        drop_session(context.user_data)
+        keyboard = [
+            [InlineKeyboardButton("📤 Дослать недостающие", callback_data="resend_missing")],
+            [InlineKeyboardButton("🔄 Новый документ", callback_data="restart")]
+        ]
+        await context.bot.send_message(
+            update.effective_chat.id,
+            f"⚠️ Есть недоставленные документы: {len(bundle.missing())}\n\n"
+            "Нажми кнопку, чтобы дослать их, или начни новый документ:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return FILLING_DATA
+
+    clear_user_data(context.user_data)
+    await context.bot.send_message(
+        update.effective_chat.id,
+        "⌛ Сессия истекла.\n\nДля начала используй /start"
+    )
+    return ConversationHandler.END
+
 async def start(update: Update, context: CallbackContext):
     """Начало работы с ботом"""
     user_id = update.effective_user.id
@@ -170,7 +799,7 @@ async def start(update: Update, context: CallbackContext):
         return ConversationHandler.END
     
     # Очищаем предыдущие данные
-    context.user_data.clear()
+    clear_user_data(context.user_data)
     
     # Создаем клавиатуру для выбора категории
     keyboard = []
@@ -194,17 +823,19 @@ async def handle_category_selection(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     
-    print(f"🔘 Нажата кнопка: {query.data}")
+    logger.info("🔘 Нажата кнопка", extra=log_extra(sampled=True, data=query.data))
     
     if query.data == "restart":
         await query.edit_message_text("🔄 Перезапускаю бота...")
-        context.user_data.clear()
+        clear_user_data(context.user_data)
         return await start_from_query(query, context)
     
     if query.data.startswith("category_"):
         category = query.data.replace("category_", "")
-        context.user_data['category'] = category
-        context.user_data['selected_templates'] = []  # Сбрасываем выбранные шаблоны
+        session = get_session(context, query.message.chat.id)
+        session.category = category
+        session.selected_templates = []  # Сбрасываем выбранные шаблоны
+        session.stop_prerender()  # Документы прошлой категории больше не нужны
         
         # Создаем клавиатуру для выбора шаблонов в этой категории
         keyboard = []
@@ -243,7 +874,7 @@ async def handle_template_selection(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     
-    print(f"🔘 Нажата кнопка: {query.data}")
+    logger.info("🔘 Нажата кнопка", extra=log_extra(sampled=True, data=query.data))
     
     if query.data == "back_to_categories":
         # Возвращаемся к выбору категории
@@ -264,14 +895,17 @@ async def handle_template_selection(update: Update, context: CallbackContext):
     
     if query.data == "restart":
         await query.edit_message_text("🔄 Перезапускаю бота...")
-        context.user_data.clear()
+        clear_user_data(context.user_data)
         return await start_from_query(query, context)
     
+    session = get_session(context, query.message.chat.id)
+    
     if query.data == "select_all":
-        category = context.user_data.get('category')
+        category = session.category
         if category:
             selected = list(CATEGORIES[category].keys())
-            context.user_data['selected_templates'] = selected
+            session.selected_templates = selected
+            session.stop_prerender()
             
             # Обновляем сообщение с выбранными документами
             keyboard = []
@@ -294,10 +928,10 @@ async def handle_template_selection(update: Update, context: CallbackContext):
             return SELECTING_TEMPLATES
     
     if query.data == "continue":
-        selected = context.user_data.get('selected_templates', [])
-        category = context.user_data.get('category')
+        selected = session.selected_templates
+        category = session.category
         
-        print(f"🎯 Кнопка 'Продолжить' нажата. Выбрано: {selected}, Категория: {category}")
+        logger.info("🎯 Кнопка 'Продолжить' нажата", extra=log_extra(category=category, templates=selected))
         
         if not selected:
             await query.answer("❌ Нужно выбрать хотя бы один документ!", show_alert=True)
@@ -322,36 +956,46 @@ async def handle_template_selection(update: Update, context: CallbackContext):
             )
             return ConversationHandler.END
         
+        profile = get_user_profile(query.from_user.id)
+        
         # Получаем только те поля, которые действительно нужно спрашивать у пользователя
-        user_input_fields = get_user_input_fields(required_fields)
+        user_input_fields = get_user_input_fields(required_fields, profile)
+        
+        # Сохраняем оба списка: все поля для документов и только для вопросов
+        session.start_filling(required_fields, user_input_fields)
         
-        # Сохраняем оба списка
-        context.user_data['required_fields'] = required_fields  # Все поля для документов
-        context.user_data['user_input_fields'] = user_input_fields  # Только для вопросов
-        context.user_data['current_field_index'] = 0
-        context.user_data['field_history'] = []  # История заполненных полей для отмены
+        # Подставляем сохраненные данные врача из профиля
+        profile_values = {}
+        for field in PROFILE_FIELDS:
+            if field in required_fields and profile.get(field):
+                session.set_value(field, profile[field])
+                profile_values[field] = profile[field]
+        
+        # Пока врач отвечает на вопросы, документы готовятся в фоне
+        session.stop_prerender()  # Остался от прошлого "Продолжить"
+        session.prerender = PreRenderer(category, selected)
+        session.prerender.start(profile_values)
         
         # Начинаем заполнение
         await ask_next_question(context, query.message.chat.id)
         return FILLING_DATA
     
     # Основная логика выбора/отмены шаблонов
-    category = context.user_data.get('category')
+    category = session.category
     if not category:
         await query.edit_message_text("❌ Ошибка: категория не выбрана. Нажми /start")
         return ConversationHandler.END
     
-    selected = context.user_data.get('selected_templates', [])
+    selected = session.selected_templates
     template_name = query.data
     
     if template_name in selected:
         selected.remove(template_name)
-        print(f"➖ Убрали шаблон: {template_name}")
+        logger.debug("➖ Убрали шаблон", extra=log_extra(template=template_name))
     else:
         selected.append(template_name)
-        print(f"➕ Добавили шаблон: {template_name}")
-    
-    context.user_data['selected_templates'] = selected
+        logger.debug("➕ Добавили шаблон", extra=log_extra(template=template_name))
+    session.stop_prerender()  # Выбор изменился - пред-рендер соберется заново по "Продолжить"
     
     # Обновляем клавиатуру с отметками
     keyboard = []
@@ -398,69 +1042,44 @@ async def start_from_query(query, context):
 
 async def ask_next_question(context: CallbackContext, chat_id: int):
     """Задаем следующий вопрос - ИСПРАВЛЕНО: используем только user_input_fields"""
-    field_index = context.user_data['current_field_index']
-    user_input_fields = context.user_data['user_input_fields']
+    session = get_session(context, chat_id)
+    field_index = session.current_field_index
+    user_input_fields = session.user_input_fields
     
     # ВАЖНОЕ ИСПРАВЛЕНИЕ: проверяем границы массива
     if field_index >= len(user_input_fields):
-        print("✅ Все поля заполнены, переходим к генерации документов")
+        logger.info("✅ Все поля заполнены, переходим к генерации документов")
         await generate_documents(context, chat_id)
         return ConversationHandler.END
     
-    print(f"📝 Заполняем поле {field_index + 1}/{len(user_input_fields)}: {user_input_fields[field_index]}")
+    logger.info("📝 Заполняем поле", extra=log_extra(
+        sampled=True, field=user_input_fields[field_index], index=field_index + 1, total=len(user_input_fields)
+    ))
     
     field_name = user_input_fields[field_index]
     
-    # Названия полей как в документах
-    field_display_names = {
-        # Основные данные
-        "name": "👤 ФИО пациента",
-        "birth_date": "📅 Дата рождения (ДД.ММ.ГГГГ)",
-        "address": "📍 Адрес регистрации по месту жительства",
-        "address_fact": "🏠 Адрес фактического проживания",
-        
-        # Документы
-        "oms": "📋 Номер полиса ОМС",
-        "snils": "📘 СНИЛС",
-        
-        # Диагнозы
-        "diagnosis": "🏥 Установлен клинический диагноз",
-        "diagnosis_code": "🔢 Код по МКБ-10",
-        
-        # Медицинская информация
-        "medical_history": "📋 Anamnesis morbi",
-        "status_localis": "📊 Status localis",
-        
-        # ВМП данные
-        "wmp": "🔬 Наименование вида ВМП",
-        "wmp_oms": "💊 Наименование вида ВМП в ОМС",
-        "wmp_group": "📁 № группы ВМП",
-        "wmp_code": "🔢 Код вида ВМП",
-        "wmp_oms_group": "📂 № группы ВМП в ОМС", 
-        "wmp_oms_code": "🔣 Код вида ВМП в ОМС",
-        "patient_model": "👥 Модель пациента",
-        "treatment_method": "💉 Метод лечения ВМП",
-        
-        # ОМС данные
-        "ksg_group": "📊 Группа КСГ",
-        "operation_code": "🔪 Код операции",
-        
-        # Заключения
-        "recommendations": "📝 Рекомендации / Решение комиссии",
-        
-        # Врачи
-        "doctor": "👨‍⚕️ ФИО врача",
-        "fio_lech": "👩‍⚕️ ФИО лечащего врача (для подписи)",
-        "department": "🏢 Отделение"
-    }
+    question = FIELD_DISPLAY_NAMES.get(field_name, f"📝 {field_name}")
     
-    question = field_display_names.get(field_name, f"📝 {field_name}")
+    # Для списков подсказываем формат: запись на строку, колонки через ";"
+    if field_name in LIST_FIELDS:
+        columns = f"{LIST_COLUMN_SEPARATOR} ".join(LIST_FIELDS[field_name].values())
+        question += (
+            f"\n\nКаждая запись - с новой строки, колонки через «{LIST_COLUMN_SEPARATOR}»:\n"
+            f"{columns}\n\n"
+            "Записи можно присылать несколькими сообщениями, в конце нажми «✅ Готово».\n"
+            "Если записей нет - отправь «-»"
+        )
+        rows = session.get_value(field_name)
+        if rows:
+            question += f"\n\n📋 Уже добавлено записей: {len(rows)}"
     
     # Добавляем прогресс-бар
     progress = f"({field_index + 1}/{len(user_input_fields)})"
     
     # Добавляем кнопки навигации с возможностью отмены предыдущего шага
     keyboard = []
+    if field_name in LIST_FIELDS:
+        keyboard.extend(build_list_keyboard(session.get_value(field_name) or []))
     if field_index > 0:  # Если не первое поле - показываем кнопку "Назад"
         keyboard.append([InlineKeyboardButton("◀️ Исправить предыдущее поле", callback_data="back_to_previous")])
     
@@ -475,58 +1094,162 @@ async def ask_next_question(context: CallbackContext, chat_id: int):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-async def handle_user_input(update: Update, context: CallbackContext):
-    """Обработка ввода пользователя - ИЗМЕНЕНО: все диагнозы = клинический диагноз"""
-    user_input = update.message.text
-    field_index = context.user_data['current_field_index']
-    user_input_fields = context.user_data['user_input_fields']
+def build_list_keyboard(rows):
+    """Кнопки ввода списка: завершить, удалить последнюю запись, очистить"""
+    keyboard = [[InlineKeyboardButton(f"✅ Готово (записей: {len(rows)})", callback_data="list_done")]]
+    if rows:
+        keyboard.append([
+            InlineKeyboardButton("↩️ Удалить последнюю", callback_data="list_undo"),
+            InlineKeyboardButton("🗑 Очистить", callback_data="list_clear")
+        ])
+    return keyboard
+
+async def handle_list_input(update: Update, context: CallbackContext, session, field_name):
+    """Добавляет записи списка из сообщения; список завершается кнопкой "Готово" """
+    text = update.message.text
+    rows = session.get_value(field_name) or []
+    
+    if text.strip() == "-" and not rows:
+        return await save_field_value(context, update.effective_chat.id, update.effective_user.id, session, field_name, [])
+    
+    items, bad_lines = parse_list_input(field_name, text)
+    columns_count = len(LIST_FIELDS[field_name])
+    if bad_lines:
+        # Ничего из сообщения не добавляем, чтобы не гадать, какие строки врач исправит
+        shown = "\n".join(f"• {line[:80]}" for line in bad_lines[:5])
+        await update.message.reply_text(
+            f"❌ Больше {columns_count} колонок через «{LIST_COLUMN_SEPARATOR}» в строках:\n{shown}\n\n"
+            "Сообщение не добавлено - исправь и отправь еще раз:",
+            reply_markup=InlineKeyboardMarkup(build_list_keyboard(rows))
+        )
+        return FILLING_DATA
     
-    # Сохраняем данные
-    field_name = user_input_fields[field_index]
-    context.user_data[field_name] = user_input
+    rows = rows + items
+    session.set_value(field_name, rows)
+    await update.message.reply_text(
+        f"➕ Добавлено записей: {len(items)}, всего: {len(rows)}\n\n"
+        "Отправь еще записи или нажми «✅ Готово»:",
+        reply_markup=InlineKeyboardMarkup(build_list_keyboard(rows))
+    )
+    return FILLING_DATA
+
+async def save_field_value(context: CallbackContext, chat_id: int, user_id: int, session, field_name, user_input):
+    """Сохраняет значение поля и переходит к следующему вопросу"""
+    session.set_value(field_name, user_input)
     
     # НОВАЯ ЛОГИКА: если заполняем "diagnosis" (клинический диагноз), 
     # то автоматически заполняем ВСЕ связанные диагнозы тем же значением
     if field_name == "diagnosis":
         # Автоматически заполняем все связанные поля диагнозов
-        context.user_data["sop_diagnosis"] = user_input  # сопутствующий
-        context.user_data["main_diagnosis"] = user_input  # основной
-        print(f"💡 Автоматически заполнены все диагнозы: {user_input}")
+        session.set_value("sop_diagnosis", user_input)  # сопутствующий
+        session.set_value("main_diagnosis", user_input)  # основной
+        logger.debug("💡 Автоматически заполнены все диагнозы", extra=log_extra(value=user_input))
+    
+    # Данные врача запоминаем в профиле, чтобы не спрашивать в следующий раз
+    if field_name in PROFILE_FIELDS:
+        set_profile_value(user_id, field_name, user_input)
+    
+    # Сразу подставляем значение в документы, которые готовятся в фоне
+    prerender = session.prerender
+    if prerender is not None:
+        fields = {field_name: user_input}
+        if field_name == "diagnosis":
+            fields["sop_diagnosis"] = user_input
+            fields["main_diagnosis"] = user_input
+        prerender.update(fields)
     
     # Сохраняем в историю для возможности отмены
-    if 'field_history' not in context.user_data:
-        context.user_data['field_history'] = []
+    session.push_history(field_name)
     
-    context.user_data['field_history'].append({
-        'field_name': field_name,
-        'value': user_input,
-        'index': field_index
-    })
-    
-    print(f"💾 Сохранено поле {field_name}: {user_input}")
+    logger.info("💾 Сохранено поле", extra=log_extra(sampled=True, field=field_name, value=user_input))
     
     # Переходим к следующему полю
-    context.user_data['current_field_index'] += 1
-    await ask_next_question(context, update.effective_chat.id)
+    session.current_field_index += 1
+    await ask_next_question(context, chat_id)
     
     return FILLING_DATA
 
+async def handle_user_input(update: Update, context: CallbackContext):
+    """Обработка ввода пользователя - ИЗМЕНЕНО: все диагнозы = клинический диагноз"""
+    if 'session' not in context.user_data:
+        return await session_expired(update, context)
+    
+    user_input = update.message.text
+    session = get_session(context, update.effective_chat.id)
+    field_index = session.current_field_index
+    user_input_fields = session.user_input_fields
+    
+    if field_index >= len(user_input_fields):
+        return FILLING_DATA
+    
+    # Сохраняем данные
+    field_name = user_input_fields[field_index]
+    if field_name in LIST_FIELDS:
+        return await handle_list_input(update, context, session, field_name)
+    
+    return await save_field_value(
+        context, update.effective_chat.id, update.effective_user.id, session, field_name, user_input
+    )
+
 async def handle_navigation(update: Update, context: CallbackContext):
     """Обработка навигационных кнопок"""
     query = update.callback_query
     await query.answer()
     
-    print(f"🔘 Нажата навигационная кнопка: {query.data}")
+    logger.info("🔘 Нажата навигационная кнопка", extra=log_extra(sampled=True, data=query.data))
+    
+    if query.data == "restart":
+        await query.edit_message_text("🔄 Перезапускаю бота...")
+        clear_user_data(context.user_data)
+        return await start_from_query(query, context)
+    
+    if query.data == "resend_missing":
+        return await handle_resend_missing(update, context)
+    
+    if 'session' not in context.user_data:
+        return await session_expired(update, context)
+    
+    session = get_session(context, query.message.chat.id)
+    
+    if query.data in ("list_done", "list_undo", "list_clear"):
+        field_index = session.current_field_index
+        if field_index >= len(session.user_input_fields):
+            return FILLING_DATA
+        field_name = session.user_input_fields[field_index]
+        if field_name not in LIST_FIELDS:
+            return FILLING_DATA
+        rows = session.get_value(field_name) or []
+        
+        if query.data == "list_done":
+            await query.edit_message_reply_markup(reply_markup=None)
+            return await save_field_value(
+                context, query.message.chat.id, query.from_user.id, session, field_name, rows
+            )
+        
+        rows = rows[:-1] if query.data == "list_undo" else []
+        session.set_value(field_name, rows)
+        await query.edit_message_text(
+            f"📋 Записей в списке: {len(rows)}\n\nОтправь еще записи или нажми «✅ Готово»:",
+            reply_markup=InlineKeyboardMarkup(build_list_keyboard(rows))
+        )
+        return FILLING_DATA
     
     if query.data == "back_to_previous":
         # Возвращаемся к предыдущему полю для исправления
-        current_index = context.user_data.get('current_field_index', 0)
+        current_index = session.current_field_index
         if current_index > 0:
-            context.user_data['current_field_index'] = current_index - 1
+            session.current_field_index = current_index - 1
             
             # Удаляем последнее значение из истории
-            if context.user_data.get('field_history'):
-                context.user_data['field_history'].pop()
+            last_field = session.pop_history()
+            if last_field is not None:
+                # Откатываем это поле и в фоновом пред-рендере
+                prerender = session.prerender
+                if prerender is not None:
+                    if last_field == "diagnosis":
+                        prerender.rollback(last_field, "sop_diagnosis", "main_diagnosis")
+                    else:
+                        prerender.rollback(last_field)
             
             await query.edit_message_text("↩️ Возвращаюсь к предыдущему полю для исправления...")
             await ask_next_question(context, query.message.chat.id)
@@ -536,12 +1259,12 @@ async def handle_navigation(update: Update, context: CallbackContext):
             return FILLING_DATA
     
     elif query.data == "back_to_templates":
-        category = context.user_data.get('category')
+        category = session.category
         if category:
             # Возвращаемся к выбору шаблонов
             keyboard = []
             templates = CATEGORIES[category]
-            selected = context.user_data.get('selected_templates', [])
+            selected = session.selected_templates
             
             for template_name in templates.keys():
                 emoji = "✅" if template_name in selected else "◻️"
@@ -563,15 +1286,14 @@ async def handle_navigation(update: Update, context: CallbackContext):
             )
             return SELECTING_TEMPLATES
     
-    elif query.data == "restart":
-        await query.edit_message_text("🔄 Перезапускаю бота...")
-        context.user_data.clear()
-        return await start_from_query(query, context)
-    
     return FILLING_DATA
 
 def replace_in_paragraph(paragraph, data):
     """Заменяет плейсхолдеры в параграфе с сохранением форматирования"""
+    # Быстрый выход: в большинстве абзацев плейсхолдеров нет
+    if '{' not in paragraph.text:
+        return
+    
     for key, value in data.items():
         placeholder = f"{{{key}}}"
         if placeholder in paragraph.text:
@@ -620,27 +1342,117 @@ def replace_in_paragraph(paragraph, data):
                 except:
                     pass  # Игнорируем ошибки шрифта
 
+def fill_list_placeholders(p_element, field_name, item, number):
+    """Подставляет {field_name.column} одной записи прямо в XML абзаца (w:p)"""
+    pattern = re.compile(r'\{' + re.escape(field_name) + r'\.(\w+)\}')
+    
+    def value_for(match):
+        column = match.group(1)
+        if column == "n":
+            return str(number)
+        return str(item.get(column, ""))
+    
+    text_elements = list(p_element.iter(qn('w:t')))
+    # Сначала внутри отдельных run - так форматирование сохраняется полностью
+    for t in text_elements:
+        if t.text and '{' in t.text:
+            t.text = pattern.sub(value_for, t.text)
+    
+    # Плейсхолдер разбит на несколько run - сводим текст в первый run
+    full_text = ''.join(t.text or '' for t in text_elements)
+    if pattern.search(full_text):
+        text_elements[0].text = pattern.sub(value_for, full_text)
+        text_elements[0].set(qn('xml:space'), 'preserve')
+        for t in text_elements[1:]:
+            t.text = ''
+
+def build_list_copies(elements, field_name, items):
+    """Размножает элементы (строку таблицы или блок абзацев) по записям списка"""
+    copies = []
+    for number, item in enumerate(items, start=1):
+        for element in elements:
+            clone = copy.deepcopy(element)
+            paragraphs = [clone] if clone.tag == qn('w:p') else clone.iter(qn('w:p'))
+            for p_element in paragraphs:
+                fill_list_placeholders(p_element, field_name, item, number)
+            copies.append(clone)
+    return copies
+
+def element_text(element):
+    return ''.join(t.text or '' for t in element.iter(qn('w:t')))
+
+def row_own_text(row):
+    """Текст строки таблицы без вложенных таблиц в ее ячейках"""
+    return ''.join(
+        t.text or '' for t in row.iter(qn('w:t'))
+        if next(t.iterancestors(qn('w:tr'))) is row
+    )
+
+def expand_list_field(doc, field_name, items):
+    """Повторяет строки таблиц с {field_name.*} и блоки {#field_name}...{/field_name}.
+    Новые элементы собираются в XML целиком и вставляются одной операцией"""
+    body = doc.element.body
+    marker = f"{{{field_name}."
+    
+    # Строки таблиц (только сама строка с маркером, а не внешняя строка макета вокруг вложенной таблицы)
+    for row in list(body.iter(qn('w:tr'))):
+        if marker in row_own_text(row):
+            parent = row.getparent()
+            index = parent.index(row)
+            parent[index:index + 1] = build_list_copies([row], field_name, items)
+    
+    # Блоки абзацев между {#field_name} и {/field_name}
+    start_marker = f"{{#{field_name}}}"
+    end_marker = f"{{/{field_name}}}"
+    while True:
+        start = next((p for p in body.iter(qn('w:p')) if element_text(p).strip() == start_marker), None)
+        if start is None:
+            break
+        
+        parent = start.getparent()
+        block = []
+        end = None
+        for sibling in start.itersiblings():
+            if sibling.tag == qn('w:p') and element_text(sibling).strip() == end_marker:
+                end = sibling
+                break
+            block.append(sibling)
+        
+        if end is None:
+            # Нет закрывающего маркера - убираем только открывающий
+            logger.error(f"❌ Не найден {end_marker} для {start_marker}")
+            parent.remove(start)
+            continue
+        
+        start_index = parent.index(start)
+        end_index = parent.index(end)
+        parent[start_index:end_index + 1] = build_list_copies(block, field_name, items)
+
+def fill_document(doc, data):
+    """Заполняет плейсхолдеры в уже загруженном документе"""
+    # Сначала размножаем повторяющиеся строки и блоки списков
+    flat_data = {}
+    for key, value in data.items():
+        if isinstance(value, list):
+            expand_list_field(doc, key, value)
+        else:
+            flat_data[key] = value
+    
+    # Заполняем плейсхолдеры во всех абзацах, включая ячейки таблиц.
+    # Обходим XML напрямую: row.cells в python-docx пересчитывает всю таблицу на каждую строку
+    for p_element in doc.element.body.iter(qn('w:p')):
+        replace_in_paragraph(Paragraph(p_element, doc._body), flat_data)
+
 def fill_docx_template(template_path, data):
     """Заполняет .docx шаблон данными с сохранением форматирования"""
     try:
         # Загружаем оригинальный шаблон
-        doc = Document(template_path)
-        
-        # Заполняем плейсхолдеры в параграфах
-        for paragraph in doc.paragraphs:
-            replace_in_paragraph(paragraph, data)
-        
-        # Заполняем плейсхолдеры в таблицах
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        replace_in_paragraph(paragraph, data)
-        
+        doc = load_template(template_path)
+        fill_document(doc, data)
         return doc
         
     except Exception as e:
-        print(f"❌ Ошибка заполнения шаблона {template_path}: {e}")
+        logger.error(f"❌ Ошибка заполнения шаблона {template_path}: {e}")
         # Создаем простой документ в случае ошибки
         doc = Document()
         doc.add_heading('МЕДИЦИНСКИЙ ДОКУМЕНТ', 0)
@@ -648,103 +1460,565 @@ def fill_docx_template(template_path, data):
             doc.add_paragraph(f"{key}: {value}")
         return doc
 
+def render_document(category, template_name, data):
+    """Рендерит один документ и возвращает (содержимое .docx в байтах, сэкономлено байт)"""
+    template_file = CATEGORIES[category][template_name]
+    template_path = f"templates/{template_file}"
+    
+    if not os.path.exists(template_path):
+        doc = Document()
+        doc.add_heading(template_name, 0)
+        for key, value in data.items():
+            doc.add_paragraph(f"{key}: {value}")
+    else:
+        doc = fill_docx_template(template_path, data)
+    
+    result = save_document(doc, template_name, template_path)
+    logger.info("✅ Создан документ", extra=log_extra(template=template_name))
+    return result
+
+class PreRenderer:
+    """Фоновый пред-рендер выбранных шаблонов, пока врач заполняет форму.
+    
+    Каждое новое поле сразу подставляется в загруженные документы, поэтому
+    после последнего ответа остается только дописать недостающие поля и сохранить.
+    Все операции выполняются по очереди в отдельном потоке под asyncio.Lock.
+    """
+    
+    def __init__(self, category, selected_templates):
+        self.category = category
+        self.selected_templates = list(selected_templates)
+        self.docs = {}  # {template_name: Document} - частично заполненные документы
+        self.applied = {}  # Поля, уже подставленные в документы
+        self.remaining = None  # Поля, которые осталось подставить при финальном рендере
+        self.failed = False
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+    
+    def _schedule(self, func, *args):
+        """Ставит операцию в очередь фоновой обработки"""
+        task = asyncio.create_task(self._run(func, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, func, *args):
+        async with self._lock:
+            if self.failed:
+                return
+            try:
+                await asyncio.to_thread(func, *args)
+            except Exception as e:
+                # Пред-рендер необязателен - в худшем случае отрендерим все в конце
+                logger.warning(f"⚠️ Пред-рендер отключен: {e}")
+                self.failed = True
+            if self.failed:
+                # Ошибка или cancel() во время работы потока - документы больше не нужны
+                self.docs = {}
+    
+    def _load(self, fields):
+        """Загружает шаблоны и подставляет уже известные поля"""
+        self.docs = {}
+        for template_name in self.selected_templates:
+            template_path = f"templates/{CATEGORIES[self.category][template_name]}"
+            if os.path.exists(template_path):
+                doc = load_template(template_path)
+                fill_document(doc, fields)
+                self.docs[template_name] = doc
+    
+    def _apply(self, fields):
+        for doc in self.docs.values():
+            fill_document(doc, fields)
+    
+    def start(self, fields):
+        """Начинает пред-рендер с полями, известными заранее (например из профиля)"""
+        self.applied = dict(fields)
+        self._schedule(self._load, dict(fields))
+    
+    def update(self, fields):
+        """Подставляет новые значения полей ({поле: значение})"""
+        reload = any(field_name in self.applied for field_name in fields)
+        self.applied.update(fields)
+        if reload:
+            # Плейсхолдер уже заменен старым значением - собираем документы заново
+            self._schedule(self._load, dict(self.applied))
+        else:
+            self._schedule(self._apply, dict(fields))
+    
+    def rollback(self, *field_names):
+        """Откатывает поля (кнопка "Исправить предыдущее поле") - одна перезагрузка на все"""
+        removed = [field_name for field_name in field_names if field_name in self.applied]
+        if removed:
+            for field_name in removed:
+                del self.applied[field_name]
+            self._schedule(self._load, dict(self.applied))
+    
+    def cancel(self):
+        """Останавливает пред-рендер: очередь операций пропускается, документы освобождаются"""
+        self.failed = True
+        self.docs = {}
+    
+    def memory_size(self):
+        """Примерный объем памяти загруженных документов в байтах"""
+        return sum(
+            _template_memory.get(f"templates/{CATEGORIES[self.category][template_name]}", 0)
+            for template_name in list(self.docs)
+        )
+    
+    def _finish_one(self, template_name, data):
+        if self.remaining is None:
+            # Если какие-то значения разошлись с итоговыми - пересобираем с верными
+            stale = [k for k, v in self.applied.items() if data.get(k) != v]
+            if stale:
+                self.applied = {k: v for k, v in self.applied.items() if k not in stale}
+                self._load(self.applied)
+            self.remaining = {k: v for k, v in data.items() if k not in self.applied}
+        
+        doc = self.docs.pop(template_name, None)
+        if doc is None:
+            return render_document(self.category, template_name, data)
+        
+        fill_document(doc, self.remaining)
+        template_path = f"templates/{CATEGORIES[self.category][template_name]}"
+        result = save_document(doc, template_name, template_path)
+        logger.info("✅ Создан документ (пред-рендер)", extra=log_extra(template=template_name))
+        return result
+    
+    async def render(self, template_name, data):
+        """Дописывает оставшиеся поля в документ и возвращает (байты, сэкономлено байт)"""
+        async with self._lock:
+            if self.failed:
+                return await asyncio.to_thread(render_document, self.category, template_name, data)
+            return await asyncio.to_thread(self._finish_one, template_name, data)
+
+async def render_documents_to_queue(queue, category, selected_templates, data, prerender=None):
+    """Производитель конвейера: рендерит документы по порядку и кладет их в очередь.
+    В конце кладет None, при ошибке - само исключение"""
+    try:
+        for template_name in selected_templates:
+            if prerender is not None:
+                content, saved = await prerender.render(template_name, data)
+            else:
+                content, saved = await asyncio.to_thread(render_document, category, template_name, data)
+            await queue.put((template_name, content, saved))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+        return
+    await queue.put(None)
+
+# Общий лимит одновременных отправок (создается внутри event loop)
+_upload_semaphore = None
+
+def get_upload_semaphore():
+    """Возвращает семафор, ограничивающий число одновременных отправок файлов"""
+    global _upload_semaphore
+    if _upload_semaphore is None:
+        _upload_semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENT_UPLOADS))
+    return _upload_semaphore
+
+async def call_with_retry(func, *args, **kwargs):
+    """Вызывает метод Bot API с повторами.
+    
+    RetryAfter (flood control) - ждем столько, сколько попросил Telegram.
+    Сетевые ошибки и таймауты - экспоненциальная задержка со случайным разбросом.
+    BadRequest и прочие ошибки запроса не повторяем.
+    """
+    for attempt in range(DELIVERY_RETRIES + 1):
+        try:
+            async with get_upload_semaphore():
+                return await func(*args, **kwargs)
+        except RetryAfter as e:
+            if attempt >= DELIVERY_RETRIES:
+                raise
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            logger.warning(f"⏳ Flood control, ждем {delay} с")
+        except BadRequest:
+            raise
+        except NetworkError as e:
+            if attempt >= DELIVERY_RETRIES:
+                raise
+            delay = min(DELIVERY_BACKOFF * 2 ** attempt, DELIVERY_BACKOFF_MAX) * random.uniform(0.5, 1.5)
+            logger.warning(f"⏳ Сетевая ошибка ({e}), повтор через {delay:.1f} с")
+        await asyncio.sleep(delay)
+
+async def upload_document(context: CallbackContext, chat_id: int, template_name, content, saved=0):
+    """Отправляет готовый документ пользователю"""
+    safe_display_name = re.sub(r'[^\w\s-]', '', template_name)
+    
+    started = time.monotonic()
+    await call_with_retry(
+        context.bot.send_document,
+        chat_id=chat_id,
+        document=content,
+        filename=f"{safe_display_name}.docx",
+        caption=f"✅ {template_name}"
+    )
+    elapsed = time.monotonic() - started
+    
+    # Оценка выигрыша по времени: при той же скорости сэкономленные байты не пришлось передавать
+    logger.info("📤 Отправлен файл", extra=log_extra(
+        template=template_name, size=len(content), seconds=round(elapsed, 2),
+        saved_seconds=round(elapsed * saved / max(1, len(content)), 2)
+    ))
+
+class DeliveryBundle:
+    """Готовые документы, которые держим в памяти, пока все не доставлены"""
+    
+    __slots__ = ('documents', 'delivered', 'last_activity')
+    
+    def __init__(self):
+        self.documents = []  # [(template_name, bytes, сэкономлено байт)] в порядке отправки
+        self.delivered = []  # Флаги доставки по индексу документа
+        self.last_activity = time.monotonic()
+    
+    def add(self, template_name, content, saved=0):
+        self.documents.append((template_name, content, saved))
+        self.delivered.append(False)
+        return len(self.documents) - 1
+    
+    def mark_delivered(self, index):
+        self.delivered[index] = True
+        self.last_activity = time.monotonic()
+    
+    def missing(self):
+        """Индексы документов, которые еще не доставлены"""
+        return [index for index, done in enumerate(self.delivered) if not done]
+
+async def deliver_missing(context: CallbackContext, chat_id: int, bundle):
+    """Досылает недоставленные документы по порядку. Возвращает True, если доставлено все"""
+    for index in bundle.missing():
+        template_name, content, saved = bundle.documents[index]
+        try:
+            await upload_document(context, chat_id, template_name, content, saved)
+        except TelegramError as e:
+            logger.error(f"Не удалось отправить {template_name}: {e}")
+            return False
+        bundle.mark_delivered(index)
+    return True
+
+async def report_delivery(context: CallbackContext, chat_id: int, bundle):
+    """Финальное сообщение: все готово или кнопка "дослать недостающие" """
+    missing = bundle.missing()
+    
+    if not missing:
+        context.user_data.pop('pending_bundle', None)
+        keyboard = [
+            [InlineKeyboardButton("🔄 Новый документ", callback_data="restart")]
+        ]
+        await call_with_retry(
+            context.bot.send_message,
+            chat_id,
+            "🎉 Все документы готовы!\n\n"
+            "Для нового документа нажми кнопку ниже:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    # Документы уже отрендерены - храним их, чтобы дослать без повторного заполнения
+    context.user_data['pending_bundle'] = bundle
+    missing_names = ', '.join(bundle.documents[index][0] for index in missing)
+    keyboard = [
+        [InlineKeyboardButton("📤 Дослать недостающие", callback_data="resend_missing")],
+        [InlineKeyboardButton("🔄 Новый документ", callback_data="restart")]
+    ]
+    await call_with_retry(
+        context.bot.send_message,
+        chat_id,
+        f"⚠️ Не удалось отправить документов: {len(missing)} из {len(bundle.documents)}\n"
+        f"📝 {missing_names}\n\n"
+        "Документы сохранены - нажми кнопку, чтобы дослать их:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def handle_resend_missing(update: Update, context: CallbackContext):
+    """Кнопка "Дослать недостающие": повторная отправка без повторного рендера"""
+    query = update.callback_query
+    await query.answer()
+    
+    bundle = context.user_data.get('pending_bundle')
+    if bundle is None or not bundle.missing():
+        await query.edit_message_text("⌛ Документов для отправки нет.\n\nДля нового документа используй /start")
+        return FILLING_DATA
+    
+    await query.edit_message_text(f"📤 Досылаю документы: {len(bundle.missing())}...")
+    await deliver_missing(context, query.message.chat.id, bundle)
+    await report_delivery(context, query.message.chat.id, bundle)
+    return FILLING_DATA
+
 async def generate_documents(context: CallbackContext, chat_id: int):
     """Генерация и отправка Word документов"""
-    user_data = context.user_data
-    selected_templates = user_data.get('selected_templates', [])
-    category = user_data.get('category')
+    session = get_session(context, chat_id)
+    selected_templates = session.selected_templates
+    category = session.category
     
     if not selected_templates or not category:
         await context.bot.send_message(chat_id, "❌ Ошибка: не выбраны шаблоны или категория")
         return ConversationHandler.END
     
     # Собираем все данные для документов
-    data = {}
-    required_fields = user_data.get('required_fields', [])
-    for field in required_fields:
-        data[field] = user_data.get(field, "Не указано")
+    data = session.to_data()
     
     # НОВАЯ ЛОГИКА: убедимся что ВСЕ диагнозы совпадают с клиническим
     if "diagnosis" in data:
         # Автоматически заполняем все связанные диагнозы
         data["sop_diagnosis"] = data["diagnosis"]  # сопутствующий
         data["main_diagnosis"] = data["diagnosis"]  # основной
-        print(f"💡 Все диагнозы установлены равными клиническому: {data['diagnosis']}")
-    
-    print(f"🎯 Генерируем документы для {category}: {selected_templates}")
+        logger.debug("💡 Все диагнозы установлены равными клиническому", extra=log_extra(value=data['diagnosis']))
+    
+    logger.info("🎯 Генерируем документы", extra=log_extra(category=category, templates=selected_templates))
+    
+    # Конвейер: пока отправляется документ N, в отдельном потоке рендерится N+1.
+    # Очередь ограничена RENDER_AHEAD, чтобы не держать в памяти весь пакет сразу.
+    queue = asyncio.Queue(maxsize=max(1, RENDER_AHEAD))
+    prerender = session.prerender
+    if prerender is not None and prerender.selected_templates != selected_templates:
+        prerender = None
+    producer = asyncio.create_task(
+        render_documents_to_queue(queue, category, selected_templates, data, prerender)
+    )
     
-    temp_dir = tempfile.mkdtemp()
+    bundle = DeliveryBundle()
+    context.user_data.pop('pending_bundle', None)
     
     try:
-        generated_files = []
+        await call_with_retry(context.bot.send_message, chat_id, "📄 Генерирую документы...")
         
-        for template_name in selected_templates:
-            template_file = CATEGORIES[category][template_name]
-            template_path = f"templates/{template_file}"
-            
-            safe_template_name = re.sub(r'[^\w\s-]', '', template_name)
-            safe_template_name = safe_template_name.replace(' ', '_')
-            
-            if not os.path.exists(template_path):
-                doc = Document()
-                doc.add_heading(template_name, 0)
-                for key, value in data.items():
-                    doc.add_paragraph(f"{key}: {value}")
-            else:
-                doc = fill_docx_template(template_path, data)
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{safe_template_name}_{timestamp}.docx"
-            file_path = os.path.join(temp_dir, filename)
-            doc.save(file_path)
-            generated_files.append((template_name, file_path))
-            print(f"✅ Создан файл: {file_path}")
-        
-        if generated_files:
-            await context.bot.send_message(chat_id, "📄 Генерирую документы...")
-            
-            for template_name, file_path in generated_files:
-                safe_display_name = re.sub(r'[^\w\s-]', '', template_name)
-                
-                with open(file_path, 'rb') as doc_file:
-                    await context.bot.send_document(
-                        chat_id=chat_id,
-                        document=doc_file,
-                        filename=f"{safe_display_name}.docx",
-                        caption=f"✅ {template_name}"
-                    )
-                print(f"📤 Отправлен файл: {file_path}")
+        delivery_failed = False
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
             
-            shutil.rmtree(temp_dir)
-            print("🧹 Временные файлы удалены")
+            template_name, content, saved = item
+            index = bundle.add(template_name, content, saved)
             
-            keyboard = [
-                [InlineKeyboardButton("🔄 Новый документ", callback_data="restart")]
-            ]
-            
-            await context.bot.send_message(
-                chat_id,
-                "🎉 Все документы готовы!\n\n"
-                "⚠️ Временные файлы удалены из системы\n\n"
-                "Для нового документа нажми кнопку ниже:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            # После ошибки доставки продолжаем только рендерить - досылать будем по кнопке
+            if delivery_failed:
+                continue
+            try:
+                await upload_document(context, chat_id, template_name, content, saved)
+                bundle.mark_delivered(index)
+            except TelegramError as e:
+                logger.error(f"Не удалось отправить {template_name}: {e}")
+                delivery_failed = True
+        
+        if bundle.documents:
+            await report_delivery(context, chat_id, bundle)
         else:
             await context.bot.send_message(chat_id, "❌ Не удалось сгенерировать документы")
         
     except Exception as e:
         logger.error(f"Ошибка генерации: {e}")
         await context.bot.send_message(chat_id, f"❌ Произошла ошибка при генерации документов: {str(e)}")
-        
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
     
     finally:
-        context.user_data.clear()
+        if not producer.done():
+            producer.cancel()
+        # Данные формы больше не нужны; недоставленные документы остаются в pending_bundle
+        drop_session(context.user_data)
+
+def build_profile_keyboard(user_id):
+    """Клавиатура редактирования профиля врача"""
+    profile = get_user_profile(user_id)
+    keyboard = []
+    for field in PROFILE_FIELDS:
+        value = profile.get(field, "—")
+        keyboard.append([InlineKeyboardButton(
+            f"✏️ {FIELD_DISPLAY_NAMES.get(field, field)}: {value}",
+            callback_data=f"profile_{field}"
+        )])
+    keyboard.append([InlineKeyboardButton("🗑 Сбросить профиль", callback_data="profile_clear")])
+    keyboard.append([InlineKeyboardButton("✅ Готово", callback_data="profile_done")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_profile(update: Update, context: CallbackContext):
+    """Показ и редактирование сохраненных данных врача"""
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMINS:
+        await update.message.reply_text("❌ Доступ запрещен.")
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        "👨‍⚕️ Данные врача подставляются в документы автоматически.\n\n"
+        "Нажми на поле чтобы изменить его:",
+        reply_markup=build_profile_keyboard(user_id)
+    )
+    return PROFILE_MENU
+
+async def handle_profile_menu(update: Update, context: CallbackContext):
+    """Обработка кнопок меню профиля"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    logger.info("🔘 Нажата кнопка профиля", extra=log_extra(sampled=True, data=query.data))
+    
+    if query.data == "profile_done":
+        await query.edit_message_text("✅ Профиль сохранен.\n\nДля нового документа используй /start")
+        return ConversationHandler.END
+    
+    if query.data == "profile_clear":
+        clear_user_profile(user_id)
+        await query.edit_message_text(
+            "🗑 Профиль очищен. Данные врача будут спрошены при следующем заполнении.\n\n"
+            "Нажми на поле чтобы изменить его:",
+            reply_markup=build_profile_keyboard(user_id)
+        )
+        return PROFILE_MENU
+    
+    field_name = query.data.replace("profile_", "")
+    if field_name not in PROFILE_FIELDS:
+        return PROFILE_MENU
+    
+    get_session(context, query.message.chat.id).profile_field = field_name
+    await query.edit_message_text(f"{FIELD_DISPLAY_NAMES.get(field_name, field_name)}\n\nВведи новое значение:")
+    return PROFILE_INPUT
+
+async def handle_profile_input(update: Update, context: CallbackContext):
+    """Сохранение нового значения поля профиля"""
+    user_id = update.effective_user.id
+    session = context.user_data.get('session')
+    field_name = session.profile_field if session is not None else None
+    
+    if field_name not in PROFILE_FIELDS:
+        # Сессию удалил таймаут - неизвестно, какое поле вводилось
+        await update.message.reply_text(
+            "⌛ Сессия истекла, значение не сохранено.\n\nВыбери поле заново:",
+            reply_markup=build_profile_keyboard(user_id)
+        )
+        return PROFILE_MENU
+    
+    session = get_session(context, update.effective_chat.id)
+    session.profile_field = None
+    set_profile_value(user_id, field_name, update.message.text)
+    logger.info("💾 Обновлено поле профиля", extra=log_extra(field=field_name))
+    
+    await update.message.reply_text(
+        "✅ Сохранено!\n\nНажми на поле чтобы изменить его:",
+        reply_markup=build_profile_keyboard(user_id)
+    )
+    return PROFILE_MENU
+
+async def show_sessions(update: Update, context: CallbackContext):
+    """Активные сессии и занимаемая ими память (для админов)"""
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text("❌ Доступ запрещен.")
+        return
+    
+    now = time.monotonic()
+    lines = []
+    total_size = 0
+    prerender_size = 0
+    
+    bundle_count = 0
+    bundle_size = 0
+    
+    for user_id, user_data in context.application.user_data.items():
+        bundle = user_data.get('pending_bundle')
+        if bundle is not None:
+            bundle_count += 1
+            bundle_size += sum(len(content) for _, content, _ in bundle.documents)
+        
+        session = user_data.get('session')
+        if session is None:
+            continue
+        
+        size = session.memory_size()
+        total_size += size
+        
+        if session.user_input_fields:
+            progress = f"поле {session.current_field_index}/{len(session.user_input_fields)}"
+        else:
+            progress = "выбор шаблонов"
+        prerender = ""
+        if session.prerender is not None and session.prerender.docs:
+            docs_size = session.prerender.memory_size()
+            prerender_size += docs_size
+            prerender = f", пред-рендер: {len(session.prerender.docs)} док. ~{docs_size // 1024} КБ"
+        
+        lines.append(
+            f"• {user_id}: {session.category or '—'}, {progress}, {size} Б, "
+            f"простой {int(now - session.last_activity)} с{prerender}"
+        )
+    
+    ttl = f"{SESSION_TTL} с" if SESSION_TTL > 0 else "выключен"
+    await update.message.reply_text(
+        f"📊 Активных сессий: {len(lines)}\n"
+        f"💾 Память сессий: {total_size} Б\n"
+        f"📄 Пред-рендер: ~{prerender_size // 1024} КБ\n"
+        f"📤 Недоставленных пакетов: {bundle_count} ({bundle_size} Б)\n"
+        f"⌛ Таймаут: {ttl}\n\n" + "\n".join(lines)
+    )
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных чатов параллельно, а одного чата - строго по очереди.
+
+    Без этого ConversationHandler одного врача мог бы получить два обновления
+    одновременно и перепутать переходы между состояниями.
+
+    Семафор PTB берется до do_process_update, и обновления, ждущие блокировку
+    своего чата, занимали бы слоты остальных чатов. Поэтому семафору PTB отдаем
+    заведомо большой лимит, а свой берем уже после блокировки чата.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(UNLIMITED_UPDATES)
+        self._limit = max_concurrent_updates
+        self._update_semaphore = None
+        self._chat_locks = {}  # {chat_id: [asyncio.Lock, число ожидающих]}
+    
+    def get_semaphore(self):
+        """Семафор на CONCURRENT_UPDATES обновлений (создается внутри event loop)"""
+        if self._update_semaphore is None:
+            self._update_semaphore = asyncio.Semaphore(self._limit)
+        return self._update_semaphore
+    
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        user = getattr(update, 'effective_user', None)
+        key = chat.id if chat else (user.id if user else None)
+        
+        if key is None:
+            async with self.get_semaphore():
+                await coroutine
+            return
+        
+        entry = self._chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.get_semaphore():
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+async def post_init(application):
+    """Запуск фоновых задач после инициализации бота"""
+    if SESSION_TTL > 0:
+        application.bot_data['session_sweeper'] = asyncio.create_task(expire_idle_sessions(application))
+
+async def post_shutdown(application):
+    """Остановка фоновых задач"""
+    sweeper = application.bot_data.pop('session_sweeper', None)
+    if sweeper is not None:
+        sweeper.cancel()
 
 async def cancel(update: Update, context: CallbackContext):
     """Отмена операции"""
-    context.user_data.clear()
+    clear_user_data(context.user_data)
     await update.message.reply_text(
         "❌ Операция отменена.\n"
         "Все временные данные удалены.\n\n"
@@ -753,29 +2027,53 @@ async def cancel(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 def main():
-    # Проверяем что переменные загружены
-    if not BOT_TOKEN or not ADMINS:
-        print("❌ Не удалось загрузить переменные из .env файла!")
-        return
+    # Логирование через очередь - только для самого бота, не при импорте
+    # (check_templates.py запускает рабочие процессы, в которых нет потока записи)
+    setup_logging()
+    
+    # Проверяем что токен и админы загружены
+    # (проверка здесь, а не при импорте - модуль импортирует check_templates.py)
+    if not BOT_TOKEN:
+        logger.error("❌ BOT_TOKEN не найден в .env файле!")
+        sys.exit(1)
+    
+    if not ADMINS:
+        logger.error("❌ ADMINS не найдены в .env файле!")
+        sys.exit(1)
+    
+    logger.info(f"✅ Токен загружен: {'*' * 10}{BOT_TOKEN[-5:]}")
+    logger.info(f"✅ Админы: {len(ADMINS)}")
     
-    print("🤖 Запускаю бота...")
-    print("🔍 Проверяю шаблоны...")
+    logger.info("🤖 Запускаю бота...")
+    logger.info("🔍 Проверяю шаблоны...")
     
     # Проверяем все шаблоны
     for category, templates in CATEGORIES.items():
-        print(f"\n📁 Категория: {category}")
         for template_name, template_file in templates.items():
             template_path = f"templates/{template_file}"
             if os.path.exists(template_path):
                 fields = analyze_docx_template(template_path)
-                print(f"   ✅ {template_name}: {len(fields)} полей")
+                logger.info(f"✅ {category} / {template_name}: {len(fields)} полей")
             else:
-                print(f"   ❌ {template_name}: файл не найден")
-    
-    application = Application.builder().token(BOT_TOKEN).build()
+                logger.error(f"❌ {category} / {template_name}: файл не найден")
+    
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(max(1, CONCURRENT_UPDATES)))
+        .connection_pool_size(max(1, CONNECTION_POOL_SIZE))
+        .pool_timeout(POOL_TIMEOUT)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', start),
+            CommandHandler('profile', show_profile),
+            CallbackQueryHandler(handle_resend_missing, pattern="^resend_missing$")
+        ],
         states={
             SELECTING_CATEGORY: [
                 CallbackQueryHandler(handle_category_selection)
@@ -786,21 +2084,27 @@ def main():
             FILLING_DATA: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_input),
                 CallbackQueryHandler(handle_navigation)
+            ],
+            PROFILE_MENU: [
+                CallbackQueryHandler(handle_profile_menu)
+            ],
+            PROFILE_INPUT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_profile_input)
             ]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CommandHandler('start', start)
+            CommandHandler('start', start),
+            CommandHandler('profile', show_profile)
         ]
     )
     
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("sessions", show_sessions))
     
-    print("\n✅ Бот запущен!")
-    print("📱 Телеграм -> /start")
-    print("⏹️  Ctrl+C для остановки")
+    logger.info("✅ Бот запущен! Команды: /start, /profile, /sessions (админам). Ctrl+C для остановки")
     
     application.run_polling()
 